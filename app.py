@@ -1,17 +1,155 @@
 ﻿# app.py
 from flask import Flask, jsonify
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import orjson
+from google.api_core.exceptions import PreconditionFailed
+from requests.exceptions import HTTPError
 
 from config import AppConfig
 from services.quickbase_client import QuickbaseClient
 from services.gcs_writer import GCSWriter
 from services.bq_writer import BQWriter
-from utils import gcs_object_epoch_ms
+from services.bq_stream_writer import BQStreamWriter
+from schemas.field_mappings import QuickBaseSchema
+from utils import gcs_object_epoch_ms, qb_timestamp_epoch_ms
+
+# Pages buffered between the Quickbase fetch and the GCS append
+PAGE_QUEUE_SIZE = 4
+
+# Adaptive page size: grow while rows/sec keeps improving, halve on 413/5xx
+PAGE_GROWTH_MIN_GAIN = 1.05
+MIN_PAGE_SIZE = 100
+
+# Incremental checkpoint object, stored next to the exports
+CHECKPOINT_NAME = "_checkpoint.json"
+
+def _load_checkpoint(gcs):
+    """
+    Read the last successful run (epoch ms) from GCS.
+    Returns (last_run_ms, generation); (None, 0) before the first successful run.
+    """
+    blob = gcs.bucket.get_blob(f"{gcs.prefix}/{CHECKPOINT_NAME}")
+    if blob is None:
+        return None, 0
+    state = orjson.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+    return state.get("last_run_ms"), blob.generation
+
+def _save_checkpoint(gcs, ms, generation):
+    """
+    Overwrite the checkpoint only if it is still at `generation` (0 = must not exist yet),
+    so two concurrent runs cannot silently move it backwards.
+    """
+    blob = gcs.bucket.blob(f"{gcs.prefix}/{CHECKPOINT_NAME}")
+    blob.upload_from_string(
+        orjson.dumps({"last_run_ms": ms}),
+        content_type="application/json",
+        if_generation_match=generation,
+    )
+
+# Keyset order: modified date (fid 2), then record id (fid 3) to break ties
+KEYSET_SORT = [{"fieldId": 2, "order": "ASC"}, {"fieldId": 3, "order": "ASC"}]
+
+def _keyset_where(since_ms, cursor):
+    """
+    WHERE for the next page: records after the last (modified_ms, record_id) seen.
+    The first page only applies the incremental checkpoint (if any).
+    """
+    if cursor is None:
+        return f"{{2.OAF.{since_ms}}}" if since_ms else None
+    modified_ms, record_id = cursor
+    return f"{{2.AF.{modified_ms}}}OR({{2.EX.{modified_ms}}}AND{{3.GT.{record_id}}})"
+
+def _page_too_large(exc):
+    """413 / 5xx that survived the client's retries (not 429): worth retrying with a smaller page."""
+    status = getattr(exc.response, "status_code", None)
+    return status == 413 or (status is not None and status >= 500)
+
+def _producer(qb, page_size, since_ms, q, stop):
+    """Fetch Quickbase pages in keyset order into `q`, adapting page_size; None is always pushed last."""
+    cursor = None
+    last_rps = 0.0
+    max_page_size = qb.MAX_PAGE_SIZE  # lowered to the halved size after a 413/5xx
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                page, meta = qb.get_records_with_metadata(
+                    page_size=page_size,
+                    flatten_values=False,
+                    where=_keyset_where(since_ms, cursor),
+                    sort_by=KEYSET_SORT,
+                )
+            except HTTPError as e:
+                if page_size <= MIN_PAGE_SIZE or not _page_too_large(e):
+                    raise
+                page_size = max(page_size // 2, MIN_PAGE_SIZE)
+                max_page_size = page_size
+                continue
+            elapsed = time.monotonic() - started
+            if not page:
+                break
+            q.put(page)
+            # totalRecords counts every row matching this page's WHERE (skip is always 0)
+            if len(page) >= meta.get("totalRecords", float("inf")):
+                break
+            last = page[-1]  # pages are sorted, so the last record is the new lower bound
+            cursor = (qb_timestamp_epoch_ms(last["2"]["value"]), last["3"]["value"])
+
+            rps = len(page) / elapsed if elapsed > 0 else 0.0
+            if len(page) == page_size and page_size < max_page_size and rps > last_rps * PAGE_GROWTH_MIN_GAIN:
+                page_size = min(page_size * 2, max_page_size)
+            last_rps = rps
+    finally:
+        q.put(None)
+
+def _extract(qb, gcs, object_name, page_size, since_ms, log, on_page=None):
+    """
+    Write Quickbase pages (keyset order, newer than since_ms) into one GCS object.
+    Page N+1 is fetched while page N is appended. on_page(page), when given, runs
+    concurrently with each page's GCS append (tee); both finish before the next page.
+    Returns (pages, rows).
+    """
+    total_rows = 0
+    pages = 0
+
+    pages_q = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+    stop = threading.Event()
+    # One worker for the producer, one for the on_page tee
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        producer = pool.submit(_producer, qb, page_size, since_ms, pages_q, stop)
+        item = ()
+        try:
+            with gcs.open_export(object_name) as writer:
+                while True:
+                    item = pages_q.get()
+                    if item is None:
+                        break
+
+                    tee = pool.submit(on_page, item) if on_page is not None else None
+                    n = gcs.write_export(writer, item)
+                    if tee is not None:
+                        tee.result()  # page-level back-pressure; re-raises sink errors
+                    total_rows += n
+                    pages += 1
+                    log.info(f"Appended page #{pages} (rows={n})")
+        finally:
+            # On a write failure, unblock the producer and wait for its sentinel
+            stop.set()
+            while item is not None:
+                item = pages_q.get()
+        producer.result()  # re-raise any Quickbase fetch error
+
+    return pages, total_rows
 
 def create_app():
     app = Flask(__name__)
     cfg = AppConfig()
-    last_run = None  # in-memory checkpoint (epoch ms)
 
     logging.basicConfig(
         level=getattr(logging, cfg.LOG_LEVEL.upper(), logging.INFO),
@@ -20,7 +158,14 @@ def create_app():
     log = logging.getLogger("qb_flask")
 
     qb = QuickbaseClient(cfg.QB_REALMID, cfg.QB_USER_TOKEN, cfg.QB_TABLEID)
-    gcs = GCSWriter(cfg.PROJECT_ID, cfg.GCP_CREDENTIALS_PATH, cfg.BUCKET, cfg.GCS_PREFIX, cfg.COMPRESS_JSONL)
+    gcs = GCSWriter(
+        cfg.PROJECT_ID, cfg.GCP_CREDENTIALS_PATH, cfg.BUCKET, cfg.GCS_PREFIX, cfg.COMPRESS_JSONL,
+        export_format=cfg.EXPORT_FORMAT,
+    )
+    # Built once per worker so client connection pools and OAuth tokens survive across /run calls
+    bq_writer = BQWriter(cfg.PROJECT_ID, cfg.GCP_CREDENTIALS_PATH, cfg.BQ_LOCATION)
+    # "stream": rows also go to BigQuery through the Storage Write API during extraction
+    bq_stream = BQStreamWriter(cfg.PROJECT_ID, cfg.GCP_CREDENTIALS_PATH) if cfg.BQ_WRITE_MODE == "stream" else None
 
     @app.get("/health")
     def health():
@@ -34,50 +179,49 @@ def create_app():
             uri = f"gs://{gcs.bucket_name}/{object_name}"
             log.info(f"Starting pipeline - Target GCS object: {uri}")
 
-            nonlocal last_run
-            prev_ms = last_run  # may be None for first run
-            where = f"{{2.OAF.{prev_ms}}}" if prev_ms else None
-            log.info(f"Quickbase WHERE filter: {where}")
+            # Checkpoint lives in GCS, so restarts and other workers resume from it
+            prev_ms, checkpoint_gen = _load_checkpoint(gcs)  # prev_ms is None for first run
+            log.info(f"Quickbase WHERE filter: {_keyset_where(prev_ms, None)}")
 
             # Candidate checkpoint for this run (advance only on success)
             current_ms = gcs_object_epoch_ms(object_name)
 
-            page_size = int(cfg.PAGE_SIZE)
-            skip = 0
-            total_rows = 0
-            pages = 0
-
-            with gcs.open_jsonl(object_name) as writer:
-                while True:
-                    page = qb.get_records(
-                        page_size=page_size,
-                        skip=skip,
-                        flatten_values=False,
-                        where=where  # relies on QuickbaseClient supporting 'where'
-                    )
-                    if not page:
-                        break
-
-                    n = gcs.write_batch(writer, page)
-                    total_rows += n
-                    pages += 1
-                    log.info(f"Appended page #{pages} (skip={skip}, rows={n})")
-                    skip += page_size
-
-            log.info(f"GCS upload complete. Pages={pages}, Rows={total_rows}, GCS={uri}")
+            page_size = cfg.PAGE_SIZE  # starting size; the producer adapts it per page
 
-            # ---------- Step 2: Upsert GCS -> BigQuery staging ----------
-            log.info(f"Starting BigQuery staging upsert from: {uri}")
+            # Stream mode: Storage Write API -> temp table during extraction, then MERGE
+            temp_table = None
+            if bq_stream is not None:
+                temp_table = bq_writer.create_staging_temp_table(cfg.BQ_STAGING_DATASET, cfg.BQ_STAGING_TABLE)
+            try:
+                stream_ctx = bq_stream.open_stream(cfg.BQ_STAGING_DATASET, temp_table) if temp_table else nullcontext()
+                with stream_ctx as streams:
+                    on_page = None
+                    if streams is not None:
+                        on_page = lambda page: bq_stream.append(streams, QuickBaseSchema.transform_batch(page))
+                    pages, total_rows = _extract(qb, gcs, object_name, page_size, prev_ms, log, on_page)
 
-            bq_writer = BQWriter(cfg.PROJECT_ID, cfg.GCP_CREDENTIALS_PATH, cfg.BQ_LOCATION)
+                log.info(f"GCS upload complete. Pages={pages}, Rows={total_rows}, GCS={uri}")
 
-            staging_result = bq_writer.load_gcs_file_to_staging_upsert(
-                gcs_uri=uri,
-                dataset_id=cfg.BQ_STAGING_DATASET,
-                table_id=cfg.BQ_STAGING_TABLE,
-                # key_column="record_id",
-                # modified_ts_column="modified_date",
-            )
+                # ---------- Step 2: Upsert -> BigQuery staging ----------
+                if temp_table:
+                    log.info(f"Starting BigQuery staging MERGE from streamed temp table: {temp_table}")
+                    staging_result = bq_writer.merge_temp_into_staging(
+                        cfg.BQ_STAGING_DATASET,
+                        cfg.BQ_STAGING_TABLE,
+                        temp_table,
+                    )
+                else:
+                    log.info(f"Starting BigQuery staging upsert from: {uri}")
+                    staging_result = bq_writer.load_gcs_file_to_staging_upsert(
+                        gcs_uri=uri,
+                        dataset_id=cfg.BQ_STAGING_DATASET,
+                        table_id=cfg.BQ_STAGING_TABLE,
+                        # key_column="record_id",
+                        # modified_ts_column="modified_date",
+                    )
+            finally:
+                if temp_table:
+                    bq_writer.drop_temp_table(cfg.BQ_STAGING_DATASET, temp_table)
 
             if not staging_result.get('success'):
                 log.error(f"Staging upsert failed: {staging_result.get('message')}")
@@ -97,7 +241,10 @@ def create_app():
             )
 
             # Advance checkpoint ONLY after successful upsert
-            last_run = current_ms
+            try:
+                _save_checkpoint(gcs, current_ms, checkpoint_gen)
+            except PreconditionFailed:
+                log.warning("Checkpoint was moved by a concurrent run; keeping the stored value")
 
             return jsonify({
                 "ok": True,
@@ -106,7 +253,7 @@ def create_app():
                 "gcs_rows": total_rows,
                 "staging_result": staging_result,
                 "staging_table": staging_result.get("table_id"),
-                "last_run_ms": last_run,
+                "last_run_ms": current_ms,
                 "message": f"Pipeline complete: {total_rows} rows to GCS; upsert affected {staging_result.get('rows_affected')} rows in staging"
             })
 
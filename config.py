@@ -1,37 +1,73 @@
+import logging
 import os
 from dataclasses import dataclass
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-@dataclass
+_REQUIRED = (
+    "QB_REALMID", "QB_TABLEID", "QB_USER_TOKEN",
+    "PROJECT_ID", "GCP_CREDENTIALS_PATH", "BUCKET",
+    "BQ_STAGING_DATASET", "BQ_STAGING_TABLE",
+    "BQ_WORK_DATASET", "BQ_WORK_TABLE",
+    "BQ_CORE_DATASET", "BQ_CORE_TABLE",
+)
+
+def _env_int(name: str, default: str) -> Optional[int]:
+    """Integer env var, or None when it does not parse (reported by AppConfig.__post_init__)."""
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return None
+
+@dataclass(frozen=True, slots=True)
 class AppConfig:
     # Flask
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
     FLASK_ENV: str = os.getenv("FLASK_ENV", "Development")
     # Quickbase
-    QB_REALMID: str = os.environ["QB_REALMID"]
-    QB_TABLEID: str = os.environ["QB_TABLEID"]
-    QB_USER_TOKEN: str = os.environ["QB_USER_TOKEN"]
-    PAGE_SIZE: int = int(os.getenv("PAGE_SIZE", "1000"))
+    QB_REALMID: str = os.getenv("QB_REALMID", "")
+    QB_TABLEID: str = os.getenv("QB_TABLEID", "")
+    QB_USER_TOKEN: str = os.getenv("QB_USER_TOKEN", "")
+    PAGE_SIZE: Optional[int] = _env_int("PAGE_SIZE", "5000")
 
     # GCP / Auth
-    PROJECT_ID: str = os.environ["PROJECT_ID"]
+    PROJECT_ID: str = os.getenv("PROJECT_ID", "")
     BQ_LOCATION: str = os.getenv("BQ_LOCATION", "US")
-    GCP_CREDENTIALS_PATH: str = os.environ["GCP_CREDENTIALS_PATH"]
+    # "load": GCS file -> load job -> MERGE (backfills); "stream": Storage Write API -> MERGE
+    BQ_WRITE_MODE: str = os.getenv("BQ_WRITE_MODE", "load").lower()
+    GCP_CREDENTIALS_PATH: str = os.getenv("GCP_CREDENTIALS_PATH", "")
 
     # GCS
-    BUCKET: str = os.environ["BUCKET"]
+    BUCKET: str = os.getenv("BUCKET", "")
     GCS_PREFIX: str = os.getenv("GCS_PREFIX", "quickbase_exports/")
     COMPRESS_JSONL: bool = os.getenv("COMPRESS_JSONL", "true").lower() == "true"
+    # "jsonl": native Quickbase records (gzip per COMPRESS_JSONL); "parquet": BigQuery-shaped columns
+    EXPORT_FORMAT: str = os.getenv("EXPORT_FORMAT", "jsonl").lower()
 
     # BQ tables
-    BQ_STAGING_DATASET: str = os.environ["BQ_STAGING_DATASET"]
-    BQ_STAGING_TABLE: str = os.environ["BQ_STAGING_TABLE"]
+    BQ_STAGING_DATASET: str = os.getenv("BQ_STAGING_DATASET", "")
+    BQ_STAGING_TABLE: str = os.getenv("BQ_STAGING_TABLE", "")
 
-    BQ_WORK_DATASET: str = os.environ["BQ_WORK_DATASET"]
-    BQ_WORK_TABLE: str = os.environ["BQ_WORK_TABLE"]
+    BQ_WORK_DATASET: str = os.getenv("BQ_WORK_DATASET", "")
+    BQ_WORK_TABLE: str = os.getenv("BQ_WORK_TABLE", "")
 
-    BQ_CORE_DATASET: str = os.environ["BQ_CORE_DATASET"]
-    BQ_CORE_TABLE: str = os.environ["BQ_CORE_TABLE"]
+    BQ_CORE_DATASET: str = os.getenv("BQ_CORE_DATASET", "")
+    BQ_CORE_TABLE: str = os.getenv("BQ_CORE_TABLE", "")
 
+    def __post_init__(self):
+        # Report every problem at once, before any worker starts serving
+        errors = [f"{name} is not set" for name in _REQUIRED if not getattr(self, name)]
+        if self.PAGE_SIZE is None:
+            errors.append(f"PAGE_SIZE must be an integer, got {os.getenv('PAGE_SIZE')!r}")
+        elif not 1 <= self.PAGE_SIZE <= 10_000:  # Quickbase caps a records query at 10,000 rows
+            errors.append(f"PAGE_SIZE must be between 1 and 10000, got {self.PAGE_SIZE}")
+        if self.BQ_WRITE_MODE not in ("load", "stream"):
+            errors.append(f"BQ_WRITE_MODE must be 'load' or 'stream', got {self.BQ_WRITE_MODE!r}")
+        if self.EXPORT_FORMAT not in ("jsonl", "parquet"):
+            errors.append(f"EXPORT_FORMAT must be 'jsonl' or 'parquet', got {self.EXPORT_FORMAT!r}")
+        if self.LOG_LEVEL.upper() not in logging.getLevelNamesMapping():
+            errors.append(f"LOG_LEVEL is not a logging level: {self.LOG_LEVEL!r}")
+        if errors:
+            raise ValueError("Invalid configuration: " + "; ".join(errors))
@@ -0,0 +1,21 @@
+# gunicorn.conf.py
+# Run with: gunicorn -c gunicorn.conf.py "app:create_app()"
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+
+# Threads rather than gevent: /run already runs its own worker threads and the
+# Storage Write API client is gRPC, neither of which mixes with monkey-patching.
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+keepalive = 75
+
+# A full export can run far longer than gunicorn's 30s default
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "3600"))
+
+def on_starting(server):
+    # Validate the environment once in the master; a bad config stops gunicorn
+    # here instead of every worker crashing and being respawned.
+    from config import AppConfig
+    AppConfig()
@@ -3,8 +3,13 @@ QuickBase to BigQuery field mappings and schemas
 Maps QuickBase field IDs to meaningful BigQuery column names
 """
 
+import functools
 from dataclasses import dataclass
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterable, Iterator, Optional
+
+import orjson
+
+from utils import qb_timestamp_epoch_ms
 
 @dataclass
 class FieldMapping:
@@ -13,6 +18,49 @@ class FieldMapping:
     bq_data_type: str
     description: Optional[str] = None
 
+def _as_int(value: Any) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+def _as_float(value: Any) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+def _as_is(value: Any) -> Any:
+    return value
+
+def _as_text(value: Any) -> Optional[str]:
+    if value is None or type(value) is str:
+        return value
+    return orjson.dumps(value, default=str).decode()
+
+# Value cast per BigQuery type; TIMESTAMP/JSON/STRING values pass through unchanged
+_VALUE_CASTS = {'INTEGER': _as_int, 'FLOAT': _as_float}
+# Arrow builds need a single Python type per column: JSON/STRING become text
+_ARROW_VALUE_CASTS = {'INTEGER': _as_int, 'FLOAT': _as_float, 'JSON': _as_text, 'STRING': _as_text}
+
+# BigQuery schema type -> standard SQL type name (script DECLAREs, column DDL)
+_SQL_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64'}
+
+# SQL twin of the value casts: BigQuery type -> expression over one raw JSONL line.
+# {raw} is the line column, {path} the JSONPath of the field's "value".
+_SQL_VALUE_EXPRS = {
+    'TIMESTAMP': "SAFE_CAST(JSON_VALUE({raw}, '{path}') AS TIMESTAMP)",
+    'INTEGER': "SAFE_CAST(JSON_VALUE({raw}, '{path}') AS INT64)",
+    'FLOAT': "SAFE_CAST(JSON_VALUE({raw}, '{path}') AS FLOAT64)",
+    'JSON': "SAFE.PARSE_JSON(JSON_QUERY({raw}, '{path}'))",
+    # Scalars as text; objects/arrays as their JSON text (like _as_text)
+    'STRING': "COALESCE(JSON_VALUE({raw}, '{path}'), NULLIF(JSON_QUERY({raw}, '{path}'), 'null'))",
+}
+
 class QuickBaseSchema:
     # Your custom field mappings
     FIELD_MAPPINGS = [
@@ -34,14 +82,25 @@ class QuickBaseSchema:
         # FieldMapping('16', 'company_name', 'STRING', 'Company name'),
         # FieldMapping('17', 'additional_field', 'JSON', 'Additional field (complex data)'),
     ]
+
+    # Built once at import; FIELD_MAPPINGS is static
+    _MAPPING_DICT = {mapping.qb_field_id: mapping for mapping in FIELD_MAPPINGS}
+    _COLUMN_LIST = tuple(mapping.bq_column_name for mapping in FIELD_MAPPINGS)
+    _COLUMN_TYPES = {mapping.bq_column_name: mapping.bq_data_type for mapping in FIELD_MAPPINGS}
+    # fid -> (column name, value cast), used by the per-row hot loop
+    _TRANSFORMERS = {
+        mapping.qb_field_id: (mapping.bq_column_name, _VALUE_CASTS.get(mapping.bq_data_type, _as_is))
+        for mapping in FIELD_MAPPINGS
+    }
     
     @classmethod
     def get_field_mapping_dict(cls) -> Dict[str, FieldMapping]:
-        return {mapping.qb_field_id: mapping for mapping in cls.FIELD_MAPPINGS}
+        return cls._MAPPING_DICT
     
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def get_bigquery_schema(cls):
-        """Generate BigQuery table schema"""
+        """Generate BigQuery table schema (built once, returned as a tuple)"""
         from google.cloud import bigquery
         
         schema_fields = []
@@ -61,31 +120,166 @@ class QuickBaseSchema:
             
             schema_fields.append(field_type)
         
-        return schema_fields
+        return tuple(schema_fields)
     
     @classmethod
-    def transform_quickbase_record(cls, qb_record: Dict[str, Any]) -> Dict[str, Any]:
-        """Transform QuickBase record to BigQuery format"""
-        mapping_dict = cls.get_field_mapping_dict()
-        transformed_record = {}
+    @functools.lru_cache(maxsize=1)
+    def get_arrow_schema(cls):
+        """Generate the Arrow schema matching get_bigquery_schema (built once)"""
+        import pyarrow as pa
+        
+        arrow_types = {
+            'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+            'INTEGER': pa.int64(),
+            'FLOAT': pa.float64(),
+            'JSON': pa.string(),  # JSON text; BigQuery parses it on load
+        }
+        return pa.schema([
+            pa.field(mapping.bq_column_name, arrow_types.get(mapping.bq_data_type, pa.string()))
+            for mapping in cls.FIELD_MAPPINGS
+        ])
+    
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def merge_script_template(cls, key_column: str = 'record_id', modified_ts_column: str = 'modified_date') -> str:
+        """
+        Staging upsert script (built once per key/timestamp pair); {tgt}, {src} and {load} are left
+        for str.format. Its result is one row: (rows_loaded, rows_affected).
+        """
+        key_type = _SQL_TYPES.get(cls._COLUMN_TYPES[key_column], cls._COLUMN_TYPES[key_column])
+        update_cols = [c for c in cls._COLUMN_LIST if c != key_column]
+        set_clause = ", ".join(f"target.{c} = source.{c}" for c in update_cols)
+        insert_cols = ", ".join(f"`{c}`" for c in cls._COLUMN_LIST)
+        insert_vals = ", ".join(f"source.{c}" for c in cls._COLUMN_LIST)
+        return f"""
+            DECLARE min_key {key_type};
+            DECLARE max_key {key_type};
+            DECLARE rows_affected INT64 DEFAULT 0;
+
+            {{load}}
+
+            CREATE TEMP TABLE deduped CLUSTER BY {key_column} AS
+            SELECT * EXCEPT(rn) FROM (
+                SELECT s.*, ROW_NUMBER() OVER (
+                PARTITION BY {key_column}
+                ORDER BY {modified_ts_column} DESC
+                ) AS rn
+                FROM ({{src}}) AS s
+            )
+            WHERE rn = 1;
+
+            SET (min_key, max_key) = (SELECT AS STRUCT MIN({key_column}), MAX({key_column}) FROM deduped);
+
+            IF NOT EXISTS (
+                SELECT 1 FROM {{tgt}} AS target
+                JOIN deduped AS source ON target.{key_column} = source.{key_column}
+                WHERE target.{key_column} BETWEEN min_key AND max_key
+            ) THEN
+                INSERT INTO {{tgt}} ({insert_cols})
+                SELECT {insert_cols} FROM deduped;
+                SET rows_affected = @@row_count;
+            ELSE
+                MERGE {{tgt}} AS target
+                USING deduped AS source
+                ON target.{key_column} = source.{key_column}
+                AND target.{key_column} BETWEEN min_key AND max_key
+                WHEN MATCHED AND source.{modified_ts_column} > target.{modified_ts_column} THEN
+                UPDATE SET {set_clause}
+                WHEN NOT MATCHED THEN
+                INSERT ({insert_cols}) VALUES ({insert_vals});
+                SET rows_affected = @@row_count;
+            END IF;
+
+            DROP TABLE deduped;
+            SELECT (SELECT COUNT(*) FROM ({{src}})) AS rows_loaded, rows_affected;
+            """
+    
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def get_column_ddl(cls) -> str:
+        """Column list for DDL / LOAD DATA statements, e.g. `record_id` INT64, ... (built once)"""
+        return ", ".join(
+            f"`{mapping.bq_column_name}` {_SQL_TYPES.get(mapping.bq_data_type, mapping.bq_data_type)}"
+            for mapping in cls.FIELD_MAPPINGS
+        )
+    
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def get_raw_select_sql(cls, raw_column: str = 'raw') -> str:
+        """
+        SELECT list mapping a column of native-shape JSONL lines ({"fid": {"value": ...}})
+        to the BigQuery columns, so BigQuery can run the transform instead of Python.
+        """
+        return ",\n".join(
+            _SQL_VALUE_EXPRS.get(mapping.bq_data_type, _SQL_VALUE_EXPRS['STRING']).format(
+                raw=raw_column, path=f'$."{mapping.qb_field_id}".value'
+            ) + f" AS `{mapping.bq_column_name}`"
+            for mapping in cls.FIELD_MAPPINGS
+        )
+    
+    @classmethod
+    def transform_page_to_arrow(cls, records: Iterable[Dict[str, Any]]):
+        """
+        Transform QuickBase records to a pyarrow.Table, column by column.
+        Every mapped column is present (None where a record lacks the field).
+        """
+        import pyarrow as pa
         
-        for qb_field_id, field_data in qb_record.items():
-            if qb_field_id in mapping_dict:
-                mapping = mapping_dict[qb_field_id]
-                column_name = mapping.bq_column_name
-                raw_value = field_data.get('value')
-                
-                # Transform the value based on data type
-                if mapping.bq_data_type == 'TIMESTAMP' and raw_value:
-                    transformed_record[column_name] = raw_value
-                elif mapping.bq_data_type == 'JSON' and raw_value:
-                    transformed_record[column_name] = raw_value
-                elif mapping.bq_data_type in ['INTEGER', 'FLOAT'] and raw_value is not None:
-                    try:
-                        transformed_record[column_name] = float(raw_value) if mapping.bq_data_type == 'FLOAT' else int(raw_value)
-                    except (ValueError, TypeError):
-                        transformed_record[column_name] = None
-                else:
-                    transformed_record[column_name] = raw_value
+        schema = cls.get_arrow_schema()
+        columns = {mapping.bq_column_name: [] for mapping in cls.FIELD_MAPPINGS}
+        builders = [
+            (mapping.qb_field_id, columns[mapping.bq_column_name].append,
+             _ARROW_VALUE_CASTS.get(mapping.bq_data_type, _as_is))
+            for mapping in cls.FIELD_MAPPINGS
+        ]
+        for qb_record in records:
+            for qb_field_id, append, cast in builders:
+                field_data = qb_record.get(qb_field_id)
+                append(cast(field_data.get('value')) if field_data is not None else None)
         
-        return transformed_record
\ No newline at end of file
+        arrays = []
+        for field in schema:
+            values = columns[field.name]
+            if pa.types.is_timestamp(field.type):
+                arrays.append(cls._timestamps_to_arrow(values, field.type))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        return pa.Table.from_arrays(arrays, schema=schema)
+    
+    @staticmethod
+    def _timestamps_to_arrow(values, arrow_type):
+        """ISO 8601 strings -> Arrow timestamps (C-level cast; per-value fallback nulls bad input)"""
+        import pyarrow as pa
+        
+        try:
+            return pa.array(values, type=pa.string()).cast(arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            micros = []
+            for value in values:
+                try:
+                    micros.append(qb_timestamp_epoch_ms(value) * 1000)
+                except (ValueError, TypeError, AttributeError):
+                    micros.append(None)
+            return pa.array(micros, type=arrow_type)
+    
+    @classmethod
+    def transform_batch(cls, records: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Transform QuickBase records to BigQuery format, lazily, one record at a time.
+        Every mapped column is present, in FIELD_MAPPINGS order (None where a record lacks the field).
+        """
+        transformers = cls._TRANSFORMERS
+        template = dict.fromkeys(cls._COLUMN_LIST)
+        for qb_record in records:
+            transformed_record = template.copy()
+            for qb_field_id, field_data in qb_record.items():
+                transformer = transformers.get(qb_field_id)
+                if transformer is not None:
+                    column_name, cast = transformer
+                    transformed_record[column_name] = cast(field_data.get('value'))
+            yield transformed_record
+    
+    @classmethod
+    def transform_quickbase_record(cls, qb_record: Dict[str, Any]) -> Dict[str, Any]:
+        """Transform QuickBase record to BigQuery format"""
+        return next(cls.transform_batch((qb_record,)))
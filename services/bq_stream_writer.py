@@ -0,0 +1,179 @@
+# services/bq_stream_writer.py
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import orjson
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types, writer
+from google.oauth2 import service_account
+from google.protobuf import descriptor_pb2, descriptor_pool
+from google.protobuf.message_factory import GetMessageClass
+
+from schemas.field_mappings import QuickBaseSchema
+from utils import qb_timestamp_epoch_ms
+
+_FieldProto = descriptor_pb2.FieldDescriptorProto
+
+# BigQuery type -> proto2 field type accepted by the Storage Write API
+_PROTO_TYPES = {
+    'TIMESTAMP': _FieldProto.TYPE_INT64,   # epoch microseconds
+    'INTEGER': _FieldProto.TYPE_INT64,
+    'FLOAT': _FieldProto.TYPE_DOUBLE,
+    'JSON': _FieldProto.TYPE_STRING,
+    'STRING': _FieldProto.TYPE_STRING,
+}
+
+def _timestamp_micros(value: Any):
+    try:
+        return qb_timestamp_epoch_ms(value) * 1000
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def _json_text(value: Any) -> str:
+    return orjson.dumps(value).decode()
+
+def _text(value: Any) -> str:
+    return value if type(value) is str else _json_text(value)
+
+# BigQuery type -> encoder from the transformed (load-job) value to the proto value
+_PROTO_ENCODERS: Dict[str, Callable[[Any], Any]] = {
+    'TIMESTAMP': _timestamp_micros,
+    'INTEGER': int,
+    'FLOAT': float,
+    'JSON': _json_text,
+    'STRING': _text,
+}
+
+def _build_row_class():
+    """Generate a proto2 message class matching QuickBaseSchema.FIELD_MAPPINGS."""
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name="quickbase_row.proto", package="quickbase", syntax="proto2"
+    )
+    message = file_proto.message_type.add(name="QuickBaseRow")
+    for number, mapping in enumerate(QuickBaseSchema.FIELD_MAPPINGS, start=1):
+        message.field.add(
+            name=mapping.bq_column_name,
+            number=number,
+            type=_PROTO_TYPES.get(mapping.bq_data_type, _FieldProto.TYPE_STRING),
+            label=_FieldProto.LABEL_OPTIONAL,
+        )
+    pool = descriptor_pool.DescriptorPool()
+    pool.AddSerializedFile(file_proto.SerializeToString())
+    return GetMessageClass(pool.FindMessageTypeByName("quickbase.QuickBaseRow"))
+
+class BQStreamWriter:
+    """
+    BigQuery Storage Write API writer for transformed QuickBase rows.
+
+    - open_stream(dataset_id, table_id): open STREAM_COUNT pending streams on the table.
+    - append(streams, rows): send a batch of rows shaped like QuickBaseSchema.transform_batch
+      output, sharded across the streams by record_id.
+    Rows become visible in one atomic commit when the open_stream block exits cleanly
+    (and are discarded if it raises); no load job (and no load-job quota) involved.
+    """
+
+    # AppendRows requests are capped at 10 MB; keep headroom for the request envelope
+    MAX_REQUEST_BYTES = 9 * 1024 * 1024
+    # Parallel pending streams per open_stream; each page is split across all of them
+    STREAM_COUNT = 4
+    SHARD_COLUMN = "record_id"
+
+    def __init__(self, project_id: str, credentials_path: str) -> None:
+        creds = service_account.Credentials.from_service_account_file(credentials_path)
+        self.client = bigquery_storage_v1.BigQueryWriteClient(credentials=creds)
+        self.project_id = project_id
+
+        self.row_class = _build_row_class()
+        self.encoders = [
+            (m.bq_column_name, _PROTO_ENCODERS.get(m.bq_data_type, _text))
+            for m in QuickBaseSchema.FIELD_MAPPINGS
+        ]
+
+    @contextmanager
+    def open_stream(self, dataset_id: str, table_id: str):
+        """
+        Open STREAM_COUNT pending streams on the table and yield their append streams.
+        On clean exit the streams are finalized and committed together; on error
+        they are closed uncommitted, so none of their rows land in the table.
+        """
+        parent = self.client.table_path(self.project_id, dataset_id, table_id)
+
+        proto_descriptor = descriptor_pb2.DescriptorProto()
+        self.row_class.DESCRIPTOR.CopyToProto(proto_descriptor)
+        writer_schema = types.ProtoSchema(proto_descriptor=proto_descriptor)
+
+        write_streams = [
+            self.client.create_write_stream(
+                parent=parent,
+                write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING),
+            )
+            for _ in range(self.STREAM_COUNT)
+        ]
+        streams = [
+            writer.AppendRowsStream(self.client, types.AppendRowsRequest(
+                write_stream=write_stream.name,
+                proto_rows=types.AppendRowsRequest.ProtoData(writer_schema=writer_schema),
+            ))
+            for write_stream in write_streams
+        ]
+        try:
+            yield streams
+        finally:
+            for stream in streams:
+                if stream.is_active:  # never-used streams have no connection to close
+                    stream.close()
+
+        names = [write_stream.name for write_stream in write_streams]
+        for name in names:
+            self.client.finalize_write_stream(name=name)
+        response = self.client.batch_commit_write_streams(
+            types.BatchCommitWriteStreamsRequest(parent=parent, write_streams=names)
+        )
+        if response.stream_errors:
+            raise RuntimeError(f"Storage Write commit failed: {list(response.stream_errors)}")
+
+    def append(self, streams, rows: Iterable[Dict[str, Any]]) -> int:
+        """Serialize rows to proto and append them; returns once BigQuery acknowledged them."""
+        shards = [[] for _ in streams]
+        for key, row in self._serialize(rows):
+            shards[hash(key) % len(streams)].append(row)
+
+        futures = []
+        count = 0
+        for stream, shard in zip(streams, shards):
+            for batch in self._request_batches(shard):
+                request = types.AppendRowsRequest(
+                    proto_rows=types.AppendRowsRequest.ProtoData(
+                        rows=types.ProtoRows(serialized_rows=batch)
+                    )
+                )
+                futures.append(stream.send(request))  # streams upload concurrently
+                count += len(batch)
+        for future in futures:
+            future.result()  # raises on append errors
+        return count
+
+    def _serialize(self, rows: Iterable[Dict[str, Any]]) -> Iterable[Tuple[Any, bytes]]:
+        row_class = self.row_class
+        encoders = self.encoders
+        shard_column = self.SHARD_COLUMN
+        for row in rows:
+            message = row_class()
+            for column_name, encode in encoders:
+                value = row.get(column_name)
+                if value is not None:
+                    value = encode(value)
+                    if value is not None:
+                        setattr(message, column_name, value)
+            yield row.get(shard_column), message.SerializeToString()
+
+    def _request_batches(self, serialized: Iterable[bytes]) -> Iterable[List[bytes]]:
+        batch, size = [], 0
+        for row in serialized:
+            if batch and size + len(row) > self.MAX_REQUEST_BYTES:
+                yield batch
+                batch, size = [], 0
+            batch.append(row)
+            size += len(row)
+        if batch:
+            yield batch
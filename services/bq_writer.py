@@ -2,18 +2,25 @@
 BigQuery writer service to load data from GCS files into BigQuery tables
 """
 
-import json
 import logging
-from typing import List, Dict, Any
+import orjson
+from typing import List, Dict, Any, Iterator
 from google.cloud import bigquery
 from google.cloud import storage
 from google.oauth2 import service_account
-from io import StringIO
+import pyarrow.parquet as pq
+from isal import igzip
+import tempfile
 import uuid
 from datetime import datetime, timezone, timedelta
 from schemas.field_mappings import QuickBaseSchema
 
 class BQWriter:
+    # Ranged-read size when streaming an export back from GCS
+    READ_CHUNK_SIZE = 8 * 1024 * 1024
+    # Column holding one native-shape JSONL line per row when loading exports untouched
+    RAW_LINE_COLUMN = "raw"
+
     def __init__(self, project_id: str, credentials_path: str, location: str = 'US'):
         self.project_id = project_id
         self.location = location
@@ -46,112 +53,86 @@ class BQWriter:
         table = self.bq_client.create_table(table)
         return f"{self.project_id}.{dataset_id}.{table_id}"
 
-    def load_gcs_file_to_staging_upsert(
+    def create_staging_temp_table(self, dataset_id: str, table_id: str) -> str:
+        """
+        Ensure the staging table exists (no drop) and create a fresh temp table
+        with the same schema next to it. Returns the temp table name.
+        """
+        schema_fields = QuickBaseSchema.get_bigquery_schema()
+        self.create_table_with_schema(dataset_id, table_id, schema_fields, drop_existing=False)
+
+        temp_table = f"{table_id}__load_{uuid.uuid4().hex[:8]}"
+        self._create_temp_table(dataset_id, temp_table, schema_fields)
+        return temp_table
+
+    def drop_temp_table(self, dataset_id: str, temp_table: str) -> None:
+        """Best-effort temp cleanup (the table also auto-expires)."""
+        temp_fqid = f"{self.project_id}.{dataset_id}.{temp_table}"
+        try:
+            self.bq_client.delete_table(temp_fqid, not_found_ok=True)
+        except Exception:
+            self.logger.warning(
+                f"Could not delete temp table {temp_fqid} (it will auto-expire)."
+            )
+
+    def merge_temp_into_staging(
         self,
-        gcs_uri: str,
         dataset_id: str,
         table_id: str,
+        temp_table: str,
         *,
         key_column: str = "record_id",
         modified_ts_column: str = "modified_date",
     ) -> Dict[str, Any]:
         """
-        Upsert rows from the GCS file into the staging table by record_id.
-        Steps:
-        - Ensure staging exists (no drop).
-        - Load transformed JSONL into a fresh temp table.
-        - MERGE temp -> staging (update if newer, insert if missing).
-        - Delete temp in finally; temp also auto-expires.
+        MERGE a loaded temp table into staging (dedupe latest per key in temp,
+        update if newer, insert if missing). Does not drop the temp table.
         """
-        temp_fqid = None
-        try:
-            # Ensure staging exists (do NOT drop)
-            schema_fields = QuickBaseSchema.get_bigquery_schema()
-            staging_fqid = self.create_table_with_schema(
-                dataset_id, table_id, schema_fields, drop_existing=False
-            )
-
-            # Create fresh temp
-            temp_table = f"{table_id}__load_{uuid.uuid4().hex[:8]}"
-            temp_fqid  = self._create_temp_table(dataset_id, temp_table, schema_fields)
-
-            # Transform from GCS
-            records = self._read_and_transform_gcs_file(gcs_uri)
-            if not records:
-                return {
-                    "success": True,
-                    "message": "No records to upsert",
-                    "rows_loaded": 0,
-                    "rows_affected": 0,
-                    "table_id": staging_fqid,
-                }
-
-            # Load into temp
-            table_ref = self.bq_client.get_table(temp_fqid)
-            job_config = bigquery.LoadJobConfig(
-                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-                source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-                max_bad_records=10,
-            )
-            jsonl_data = "\n".join(json.dumps(r) for r in records)
-            load_job = self.bq_client.load_table_from_file(
-                StringIO(jsonl_data),
-                destination=table_ref,
-                job_config=job_config,
-            )
-            load_job.result()
-            if load_job.errors:
-                return {
-                    "success": False,
-                    "message": f"Load to temp failed: {load_job.errors}",
-                    "rows_loaded": 0,
-                }
-
-            # Dynamic MERGE (dedupe latest per key in temp)
-            cols = [m.bq_column_name for m in QuickBaseSchema.FIELD_MAPPINGS]
-            update_cols = [c for c in cols if c != key_column]
-            set_clause   = ", ".join([f"target.{c} = source.{c}" for c in update_cols])
-            insert_cols  = ", ".join([f"`{c}`" for c in cols])
-            insert_vals  = ", ".join([f"source.{c}" for c in cols])
-
-            project = self.project_id
-            src = f"`{project}.{dataset_id}.{temp_table}`"
-            tgt = f"`{project}.{dataset_id}.{table_id}`"
+        src = f"`{self.project_id}.{dataset_id}.{temp_table}`"
+        return self._merge_into_staging(
+            dataset_id,
+            table_id,
+            f"SELECT * FROM {src}",
+            key_column=key_column,
+            modified_ts_column=modified_ts_column,
+        )
 
-            merge_sql = f"""
-            MERGE {tgt} AS target
-            USING (
-            SELECT * EXCEPT(rn) FROM (
-                SELECT s.*, ROW_NUMBER() OVER (
-                PARTITION BY {key_column}
-                ORDER BY {modified_ts_column} DESC
-                ) AS rn
-                FROM {src} AS s
+    def _merge_into_staging(
+        self,
+        dataset_id: str,
+        table_id: str,
+        source_sql: str,
+        *,
+        load_sql: str = "",
+        key_column: str,
+        modified_ts_column: str,
+    ) -> Dict[str, Any]:
+        """
+        Run the staging upsert script: optional load_sql statements, then MERGE the rows
+        of `source_sql` (a SELECT in staging's column layout) into staging.
+        """
+        staging_fqid = f"{self.project_id}.{dataset_id}.{table_id}"
+        try:
+            tgt = f"`{self.project_id}.{dataset_id}.{table_id}`"
+            merge_script = QuickBaseSchema.merge_script_template(key_column, modified_ts_column).format(
+                tgt=tgt, src=source_sql, load=load_sql
             )
-            WHERE rn = 1
-            ) AS source
-            ON target.{key_column} = source.{key_column}
-            WHEN MATCHED AND source.{modified_ts_column} > target.{modified_ts_column} THEN
-            UPDATE SET {set_clause}
-            WHEN NOT MATCHED THEN
-            INSERT ({insert_cols}) VALUES ({insert_vals})
-            """
 
-            merge_job = self.bq_client.query(merge_sql)
-            merge_job.result()
+            merge_job = self.bq_client.query(merge_script)
+            result = list(merge_job.result())  # the script's final SELECT
             if merge_job.errors:
                 return {
                     "success": False,
                     "message": f"MERGE failed: {merge_job.errors}",
-                    "rows_loaded": len(records),
+                    "rows_loaded": 0,
                     "table_id": staging_fqid,
                 }
 
-            affected = getattr(merge_job, "num_dml_affected_rows", None)
+            rows_loaded, affected = result[0] if result else (0, 0)
             return {
                 "success": True,
                 "message": f"Upserted into {staging_fqid}",
-                "rows_loaded": len(records),   # loaded into temp
+                "rows_loaded": rows_loaded,    # staged from the source
                 "rows_affected": affected,     # changed in staging
                 "table_id": staging_fqid,
             }
@@ -159,15 +140,59 @@ class BQWriter:
         except Exception as e:
             self.logger.error(f"Upsert to staging failed: {str(e)}")
             return {"success": False, "message": str(e), "rows_loaded": 0}
-        finally:
-            # Best-effort temp cleanup
-            if temp_fqid:
-                try:
-                    self.bq_client.delete_table(temp_fqid, not_found_ok=True)
-                except Exception:
-                    self.logger.warning(
-                        f"Could not delete temp table {temp_fqid} (it will auto-expire)."
-                    )
+
+    def load_gcs_file_to_staging_upsert(
+        self,
+        gcs_uri: str,
+        dataset_id: str,
+        table_id: str,
+        *,
+        key_column: str = "record_id",
+        modified_ts_column: str = "modified_date",
+    ) -> Dict[str, Any]:
+        """
+        Upsert rows from the GCS file into the staging table by record_id.
+        Steps:
+        - Ensure staging exists (no drop).
+        - One script: LOAD DATA the GCS file as-is into a session temp table (JSONL as
+          one raw line per row, Parquet exports column for column), then MERGE it into
+          staging, transforming JSONL in SQL (update if newer, insert if missing).
+        Temp tables vanish with the script; nothing to create or clean up separately.
+        """
+        self.create_table_with_schema(
+            dataset_id, table_id, QuickBaseSchema.get_bigquery_schema(), drop_existing=False
+        )
+        source_sql, load_sql = self._load_data_sql(gcs_uri)
+        return self._merge_into_staging(
+            dataset_id,
+            table_id,
+            source_sql,
+            load_sql=load_sql,
+            key_column=key_column,
+            modified_ts_column=modified_ts_column,
+        )
+
+    def _load_data_sql(self, gcs_uri: str):
+        """
+        (source_sql, load_sql) staging a GCS export in the upsert script; no records pass
+        through Python. JSONL lines load whole into RAW_LINE_COLUMN: CSV with a tab
+        delimiter (JSON escapes tabs inside strings) and quoting disabled.
+        """
+        uri = gcs_uri.replace("\\", "\\\\").replace("'", "\\'")
+        if gcs_uri.endswith(".parquet"):
+            load_sql = (
+                f"LOAD DATA INTO TEMP TABLE staged ({QuickBaseSchema.get_column_ddl()}) "
+                f"FROM FILES (format = 'PARQUET', uris = ['{uri}']);"
+            )
+            return "SELECT * FROM staged", load_sql
+
+        compression = ", compression = 'GZIP'" if gcs_uri.endswith(".gz") else ""
+        load_sql = (
+            f"LOAD DATA INTO TEMP TABLE staged (`{self.RAW_LINE_COLUMN}` STRING NOT NULL) "
+            f"FROM FILES (format = 'CSV', field_delimiter = '\\t', quote = ''{compression}, uris = ['{uri}']);"
+        )
+        raw_select = QuickBaseSchema.get_raw_select_sql(self.RAW_LINE_COLUMN)
+        return f"SELECT {raw_select} FROM staged", load_sql
 
     def create_table_with_schema(
         self,
@@ -218,40 +243,21 @@ class BQWriter:
             full_table_id = self.create_table_with_schema(dataset_id, table_id, schema_fields)
             
             # Read and transform data from GCS
-            transformed_records = self._read_and_transform_gcs_file(gcs_uri)
+            records = self._read_gcs_file_to_arrow(gcs_uri)
             
-            if not transformed_records:
+            if not records.num_rows:
                 return {'success': False, 'message': 'No records to load', 'rows_loaded': 0}
             
-            # Log first transformed record for debugging
-            self.logger.info(f'First transformed record keys: {list(transformed_records[0].keys())}')
-            
             # Load transformed data to BigQuery
-            table_ref = self.bq_client.get_table(full_table_id)
-            
-            job_config = bigquery.LoadJobConfig(
-                write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
-                source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-                max_bad_records=10  # Allow some bad records for debugging
+            job = self._load_arrow_table(
+                records, full_table_id, bigquery.WriteDisposition.WRITE_APPEND
             )
             
-            # Convert records to JSONL format
-            jsonl_data = '\n'.join([json.dumps(record) for record in transformed_records])
-            
-            # Load data using StringIO
-            job = self.bq_client.load_table_from_file(
-                StringIO(jsonl_data),
-                destination=table_ref,
-                job_config=job_config
-            )
-            
-            job.result()  # Wait for job to complete
-            
             if job.errors:
                 self.logger.error(f'BigQuery load job errors: {job.errors}')
                 return {'success': False, 'message': f'Load job failed: {job.errors}', 'rows_loaded': 0}
             
-            rows_loaded = len(transformed_records)
+            rows_loaded = records.num_rows
             self.logger.info(f'Loaded {rows_loaded} rows to {full_table_id}')
             
             return {
@@ -265,8 +271,29 @@ class BQWriter:
             self.logger.error(f'Error loading to BigQuery: {str(e)}')
             return {'success': False, 'message': str(e), 'rows_loaded': 0}
     
-    def _read_and_transform_gcs_file(self, gcs_uri: str) -> List[Dict[str, Any]]:
-        """Read GCS file and transform QuickBase records to BigQuery format"""
+    def _load_arrow_table(self, table, destination: str, write_disposition: str):
+        """
+        Load a pyarrow.Table into BigQuery as Parquet+ZSTD; waits for the job.
+        The Parquet file is spooled to local disk, not held in memory next to the table.
+        """
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=write_disposition,
+            source_format=bigquery.SourceFormat.PARQUET,
+        )
+        with tempfile.TemporaryFile(suffix=".parquet") as parquet_file:
+            pq.write_table(table, parquet_file, compression="ZSTD", compression_level=3)
+            parquet_file.seek(0)
+            
+            job = self.bq_client.load_table_from_file(
+                parquet_file,
+                destination=destination,  # table id string; no tables.get round-trip
+                job_config=job_config,
+            )
+            job.result()  # Wait for job to complete
+        return job
+    
+    def _get_gcs_blob(self, gcs_uri: str):
+        """Resolve a gs:// URI to its blob, with metadata (one call)"""
         if not gcs_uri.startswith('gs://'):
             raise ValueError(f'Invalid GCS URI: {gcs_uri}')
         
@@ -275,56 +302,50 @@ class BQWriter:
         bucket_name = uri_parts[0]
         blob_name = uri_parts[1]
         
-        # Read file from GCS
-        bucket = self.storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        
-        if not blob.exists():
+        blob = self.storage_client.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
             raise ValueError(f'File not found in GCS: {gcs_uri}')
+        return blob
+    
+    def _iter_gcs_records(self, gcs_uri: str) -> Iterator[Dict[str, Any]]:
+        """Read a GCS JSONL file and yield the QuickBase records it contains"""
+        # Stream the file from GCS (no full download in memory)
+        blob = self._get_gcs_blob(gcs_uri)
+        self.logger.debug(f'Streaming {blob.size} bytes from GCS')
         
-        content = blob.download_as_text()
-        self.logger.info(f'Downloaded {len(content)} characters from GCS')
-        
-        # Parse JSONL content and transform each record
-        transformed_records = []
-        lines = content.strip().split('\n')
-        self.logger.info(f'Processing {len(lines)} lines from GCS file')
+        # raw_download keeps ranged reads on the stored (gzip) bytes; inflate locally
+        stream = blob.open("rb", chunk_size=self.READ_CHUNK_SIZE, raw_download=True)
+        if blob.content_encoding == "gzip":
+            stream = igzip.IGzipFile(fileobj=stream, mode="rb")
         
-        for i, line in enumerate(lines):
-            if line.strip():
+        with stream:
+            for i, line in enumerate(stream):
+                if not line.strip():
+                    continue
                 try:
-                    qb_record = json.loads(line)
-                    
-                    # Debug: Log the first record structure
-                    if i == 0:
-                        self.logger.info(f"Sample QB record fields: {list(qb_record.keys())}")
-                        self.logger.info(f"Sample QB record: {json.dumps(qb_record, indent=2)[:500]}...")
-                    
-                    transformed_record = QuickBaseSchema.transform_quickbase_record(qb_record)
-                    
-                    # Debug: Log the first transformed record
-                    if i == 0:
-                        self.logger.info(f"Sample transformed record keys: {list(transformed_record.keys()) if transformed_record else 'None'}")
-                        self.logger.info(f"Sample transformed record: {json.dumps(transformed_record, indent=2)[:500]}...")
-                    
-                    if transformed_record:
-                        # Ensure all expected fields are present (set to None if missing)
-                        expected_fields = [mapping.bq_column_name for mapping in QuickBaseSchema.FIELD_MAPPINGS]
-                        for field in expected_fields:
-                            if field not in transformed_record:
-                                transformed_record[field] = None
-                        
-                        transformed_records.append(transformed_record)
-                        
-                except json.JSONDecodeError as e:
+                    qb_record = orjson.loads(line)
+                except orjson.JSONDecodeError as e:
                     self.logger.error(f"JSON decode error on line {i}: {e}")
                     continue
-                except Exception as e:
-                    self.logger.error(f"Transform error on line {i}: {e}")
-                    continue
-        
-        self.logger.info(f"Successfully transformed {len(transformed_records)} records")
-        return transformed_records
+                
+                # Debug: Log the first record structure (formatting skipped unless DEBUG)
+                if i == 0 and self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Sample QB record fields: {list(qb_record.keys())}")
+                    self.logger.debug(f"Sample QB record: {orjson.dumps(qb_record, option=orjson.OPT_INDENT_2)[:500].decode(errors='ignore')}...")
+                
+                yield qb_record
+    
+    def _read_gcs_file_to_arrow(self, gcs_uri: str):
+        """Read GCS file and transform QuickBase records to a pyarrow.Table in BigQuery format"""
+        if gcs_uri.endswith(".parquet"):
+            # Parquet exports are already in BigQuery's column layout
+            blob = self._get_gcs_blob(gcs_uri)
+            with blob.open("rb", chunk_size=self.READ_CHUNK_SIZE) as f:
+                table = pq.read_table(f)
+        else:
+            table = QuickBaseSchema.transform_page_to_arrow(self._iter_gcs_records(gcs_uri))
+        self.logger.info(f"Successfully transformed {table.num_rows} records")
+        return table
     
     def transfer_staging_to_work_table(self, staging_dataset: str, staging_table: str, 
                                      work_dataset: str, work_table: str) -> Dict[str, Any]:
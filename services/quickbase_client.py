@@ -1,18 +1,40 @@
 # services/quickbase_client.py
-from typing import List, Dict, Optional
+import socket
+from typing import List, Dict, Optional, Tuple
+
+import orjson
+from requests import Session
+from requests.adapters import HTTPAdapter, Retry
+from urllib3.connection import HTTPConnection
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets also enable TCP keepalive (urllib3 already sets TCP_NODELAY)."""
+
+    # Probe after 60s idle, every 30s, give up after 5: inside typical 5-10 minute
+    # NAT / load-balancer idle timeouts (Linux otherwise waits 2 hours before probing)
+    SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)] + [
+        (socket.IPPROTO_TCP, getattr(socket, name), value)
+        for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 30), ("TCP_KEEPCNT", 5))
+        if hasattr(socket, name)
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self.SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
 
 class QuickbaseClient:
     """
     Minimal Quickbase client to fetch a specific page of records (no field map).
-    Returns flattened rows ({"fid": {"value": ...}} -> {"fid": ...}).
+    Returns rows in Quickbase's native shape ({"fid": {"value": ...}}), which is what
+    the GCS archive stores and QuickBaseSchema transforms; flatten_values=True opts
+    into flat rows ({"fid": ...}) for ad-hoc callers.
     """
 
     QB_QUERY_URL = "https://api.quickbase.com/v1/records/query"
+    POOL_SIZE = 16
+    MAX_PAGE_SIZE = 10_000  # largest "top" requested per page
 
     def __init__(self, realm: str, token: str, table_id: str, session: Optional[object] = None):
-        from requests import Session
-        from requests.adapters import HTTPAdapter, Retry
-
         self.realm = realm
         self.token = token
         self.table_id = table_id
@@ -23,28 +45,42 @@ class QuickbaseClient:
             backoff_factor=0.6,
             status_forcelist=(429, 500, 502, 503, 504),
             allowed_methods=["POST"],
+            raise_on_status=False,  # raise_for_status then reports the final 413/429/5xx itself
+        )
+        # One pooled session per client: TLS handshake once, reused for every page and /run
+        self.session.mount(
+            "https://",
+            _KeepAliveAdapter(pool_connections=self.POOL_SIZE, pool_maxsize=self.POOL_SIZE, max_retries=retry),
         )
-        self.session.mount("https://", HTTPAdapter(max_retries=retry))
 
         self.headers = {
             "QB-Realm-Hostname": self.realm,
             "Authorization": f"QB-USER-TOKEN {self.token}",
             "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate",  # JSON pages compress 3-10x on the wire
         }
 
-    def get_records(
+    def get_records(self, page_size: int, skip: int = 0, **kwargs) -> List[Dict]:
+        """Fetch one page (window) of records; see get_records_with_metadata for the options."""
+        rows, _ = self.get_records_with_metadata(page_size, skip, **kwargs)
+        return rows
+
+    def get_records_with_metadata(
         self,
         page_size: int,
-        skip: int,
+        skip: int = 0,
         *,
         flatten_values: bool = False,
         select_all_fields: bool = False,
         select: Optional[list] = [1,2,3,7],
         where: Optional[str] = None,
+        sort_by: Optional[list] = None,
         timeout: int = 120,
-    ) -> List[Dict]:
+    ) -> Tuple[List[Dict], Dict]:
         """
-        Fetch one page (window) of records.
+        Fetch one page (window) of records, plus the response's "metadata" object
+        (totalRecords, numRecords, skip, ...; {} if absent).
+        sort_by is passed through as Quickbase "sortBy", e.g. [{"fieldId": 2, "order": "ASC"}].
         """
         payload = {
             "from": self.table_id,
@@ -53,19 +89,19 @@ class QuickbaseClient:
         }
         if where:
             payload["where"] = where
+        if sort_by:
+            payload["sortBy"] = sort_by
 
-        resp = self.session.post(self.QB_QUERY_URL, headers=self.headers, json=payload, timeout=timeout)
+        # orjson bytes body; Content-Type is already in self.headers
+        resp = self.session.post(self.QB_QUERY_URL, headers=self.headers, data=orjson.dumps(payload), timeout=timeout)
         resp.raise_for_status()
-        js = resp.json()
+        js = orjson.loads(resp.content)  # already gunzipped by requests
         raw_rows = js.get("data", []) or []
 
-        print(raw_rows)
-        
-        if not flatten_values:
-            return raw_rows
-        
-        return [self._flatten_one(row) for row in raw_rows]
+        rows = [self._flatten_one(row) for row in raw_rows] if flatten_values else raw_rows
+        return rows, js.get("metadata") or {}
 
     @staticmethod
     def _flatten_one(rec: Dict) -> Dict:
-        return {k: (v.get("value") if isinstance(v, dict) and "value" in v else v) for k, v in rec.items()}
+        # type() is: JSON-decoded cells are exact dicts, and it skips isinstance's MRO walk
+        return {k: (v["value"] if type(v) is dict and "value" in v else v) for k, v in rec.items()}
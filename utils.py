@@ -1,15 +1,28 @@
+import calendar
 import re
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
-# Matches qb_records_20250920T145059Z.jsonl(.gz)
-_STAMP_RX = re.compile(r"_(\d{8}T\d{6}Z)")
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Matches qb_records_20250920T145059Z.jsonl(.gz) in the filename part of the object name
+_STAMP_RX = re.compile(r"_(\d{8}T\d{6}Z)[^/]*$")
 
 def gcs_object_epoch_ms(object_name: str) -> int:
     """Extract YYYYMMDDTHHMMSSZ from the object name and return epoch ms (UTC)."""
-    name = object_name.rsplit("/", 1)[-1]             # filename only
-    m = _STAMP_RX.search(name)
+    m = _STAMP_RX.search(object_name)
     if not m:
         raise ValueError(f"No timestamp like YYYYMMDDTHHMMSSZ in: {object_name}")
     stamp = m.group(1)                                # e.g. 20250920T145059Z
-    dt = datetime.strptime(stamp, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
-    return int(dt.timestamp() * 1000)
+    # Fixed-width fields: slice them rather than going through strptime
+    fields = (
+        int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8]),
+        int(stamp[9:11]), int(stamp[11:13]), int(stamp[13:15]),
+    )
+    return calendar.timegm(fields) * 1000
+
+def qb_timestamp_epoch_ms(value: str) -> int:
+    """Convert a Quickbase date-time value (e.g. 2025-09-20T14:50:59.123Z) to epoch ms (UTC)."""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - _EPOCH) // timedelta(milliseconds=1)